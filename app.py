@@ -1,15 +1,22 @@
-import os, json, time, threading
+import os, time, asyncio, hashlib, hmac, mmap, sqlite3, threading
+from collections import defaultdict
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
+import orjson
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+
 import requests
-from flask import Flask, request, redirect, jsonify, abort
-from apscheduler.schedulers.background import BackgroundScheduler
+from requests.adapters import HTTPAdapter
+from quart import Quart, Response, request, redirect, jsonify, abort
 from dotenv import load_dotenv
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.request import HTTPXRequest
 
 # ----------------- ENV -----------------
 load_dotenv()
@@ -22,39 +29,86 @@ PRICE_INR = int(os.environ.get("PRICE_INR", "2500"))
 SUBSCRIPTION_DAYS = int(os.environ.get("SUBSCRIPTION_DAYS", "30"))
 INVITE_LINK_TTL_SECONDS = int(os.environ.get("INVITE_LINK_TTL_SECONDS", "600"))
 PORT = int(os.environ.get("PORT", "10000"))
+PR_POOL_SIZE = int(os.environ.get("PR_POOL_SIZE", "4"))
 
 CRON_SECRET = os.environ.get("CRON_SECRET", "")
+TG_WEBHOOK_SECRET = os.environ.get("TG_WEBHOOK_SECRET", "")
 
 # Instamojo auth (two modes)
 IM_API_BASE = "https://www.instamojo.com/api/1.1"
 IM_BEARER = os.environ.get("INSTAMOJO_AUTH_TOKEN", "").strip()
 IM_KEY = os.environ.get("INSTAMOJO_API_KEY", "").strip()
 IM_TOKEN = os.environ.get("INSTAMOJO_API_TOKEN", "").strip()
+IM_SALT = os.environ.get("INSTAMOJO_SALT", "").strip().encode()
 
-# ----------------- Data store -----------------
+# ----------------- Data store (SQLite, WAL) -----------------
 DATA_DIR = "data"
-DATA_FILE = os.path.join(DATA_DIR, "subscribers.json")
+DB_FILE = os.path.join(DATA_DIR, "subs.db")
+LEGACY_JSON = os.path.join(DATA_DIR, "subscribers.json")
 os.makedirs(DATA_DIR, exist_ok=True)
 
-def load_db():
-    if not os.path.exists(DATA_FILE):
-        return {}
+# Shared between the event loop and to_thread workers, hence the lock.
+conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+conn.execute("PRAGMA journal_mode=WAL")
+conn.execute("PRAGMA synchronous=NORMAL")
+conn.execute(
+    "CREATE TABLE IF NOT EXISTS subs("
+    "tg_id INTEGER PRIMARY KEY, expiry_ts INTEGER, status TEXT, last_payment TEXT)"
+)
+# Partial index: the expiry query only ever looks at active rows.
+conn.execute("DROP INDEX IF EXISTS idx_exp")
+conn.execute("CREATE INDEX IF NOT EXISTS idx_active_expiry ON subs(expiry_ts) WHERE status='active'")
+# Maps pre-created payment requests to the user who was handed them.
+conn.execute("CREATE TABLE IF NOT EXISTS pending(req_id TEXT PRIMARY KEY, tg_id INTEGER)")
+DB_LOCK = threading.Lock()
+
+
+def _migrate_legacy_json():
+    # One-time import of the old subscribers.json store, if present.
+    # mmap parses straight out of the page cache, no intermediate bytes copy.
+    if not os.path.exists(LEGACY_JSON) or os.path.getsize(LEGACY_JSON) == 0:
+        return
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(LEGACY_JSON, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                legacy = orjson.loads(memoryview(mm))
     except Exception:
-        return {}
+        return
+    with DB_LOCK, conn:
+        for uid, rec in legacy.items():
+            conn.execute(
+                "INSERT OR IGNORE INTO subs VALUES(?,?,?,?)",
+                (int(uid), int(rec.get("expiry_ts", 0)), rec.get("status", "expired"), rec.get("last_payment", "")),
+            )
+    os.replace(LEGACY_JSON, LEGACY_JSON + ".migrated")
+
+_migrate_legacy_json()
 
-def save_db(data):
-    tmp = DATA_FILE + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, DATA_FILE)
 
-DB = load_db()  # { "<tg_id>": {expiry_ts:int, status:"active|expired", last_payment:"..."} }
+def upsert_sub(tg_id: int, expiry_ts: int, status: str, last_payment: str):
+    with DB_LOCK, conn:
+        conn.execute("INSERT OR REPLACE INTO subs VALUES(?,?,?,?)", (tg_id, expiry_ts, status, last_payment))
 
 # ----------------- Telegram -----------------
-app_telegram = Application.builder().token(BOT_TOKEN).build()
+# One Bot with a keep-alive HTTP/2 pool: every call reuses the same TLS
+# session to api.telegram.org instead of re-handshaking per request.
+bot = Bot(BOT_TOKEN, request=HTTPXRequest(connection_pool_size=20, http_version="2"))
+app_telegram = Application.builder().bot(bot).build()
+
+# Client-side token buckets: ~30 msg/sec global and ~1 msg/sec per chat.
+# Pacing ourselves is cheaper than eating a 429 retry_after penalty.
+TG_GLOBAL_LIMIT = AsyncLimiter(28, 1)
+TG_CHAT_LIMIT = defaultdict(lambda: AsyncLimiter(1, 1.1))
+
+
+async def tg_call(method, chat_id, **kwargs):
+    async with TG_GLOBAL_LIMIT:
+        async with TG_CHAT_LIMIT[chat_id]:
+            try:
+                return await method(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                return await method(chat_id=chat_id, **kwargs)
 
 EMOTIONAL_WELCOME = (
     "🙏 *Welcome!*\n\n"
@@ -65,6 +119,21 @@ EMOTIONAL_WELCOME = (
     "👇 नीचे बटन दबाकर सुरक्षित भुगतान करें और तुरंत join करें।"
 )
 
+# Pre-baked DM templates: everything constant (price, URLs, durations) is
+# folded in at import, leaving one %-substitution per send.
+PAYMENT_SUCCESS_TMPL = (
+    "✅ *Payment Successful!*\n\n"
+    f"यह आपकी *private invite link* है (केवल 1 बार, {INVITE_LINK_TTL_SECONDS//60} मिनट में expire):\n"
+    "%s\n\n"
+    f"_Access valid for {SUBSCRIPTION_DAYS} days._"
+)
+
+REJOIN_TMPL = (
+    "🚫 आपकी subscription खत्म हो गई है.\n"
+    f"दोबारा जुड़ने के लिए क्लिक करें और ₹{PRICE_INR} पे करें:\n"
+    f"{BASE_URL}/pay?tg=%d"
+)
+
 def pay_keyboard(tg_id: int):
     url = f"{BASE_URL}/pay?tg={tg_id}"
     return InlineKeyboardMarkup([[InlineKeyboardButton(f"💳 Pay ₹{PRICE_INR} & Join", url=url)]])
@@ -77,62 +146,142 @@ app_telegram.add_handler(CommandHandler("start", start_cmd))
 
 # ----------------- Instamojo helpers -----------------
 
-def im_headers():
-    # Prefer Bearer if provided; else legacy key+token
-    if IM_BEARER:
-        return {"Authorization": f"Bearer {IM_BEARER}", "Content-Type": "application/x-www-form-urlencoded"}
-    return {"X-Api-Key": IM_KEY, "X-Auth-Token": IM_TOKEN, "Content-Type": "application/x-www-form-urlencoded"}
+# Keep-alive session so repeated Instamojo calls reuse one TCP+TLS connection.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+# Constant after startup; no need to rebuild them per /pay hit.
+REDIRECT_URL = f"{BASE_URL}/payment-return"
+WEBHOOK_URL = f"{BASE_URL}/instamojo-webhook"
+AMOUNT_STR = str(PRICE_INR)
+METADATA_TMPL = '{"telegram_user_id": "%d"}'
+
+
+# Prefer Bearer if provided; else legacy key+token. Never changes at runtime.
+IM_HEADERS = (
+    {"Authorization": f"Bearer {IM_BEARER}"}
+    if IM_BEARER
+    else {"X-Api-Key": IM_KEY, "X-Auth-Token": IM_TOKEN}
+)
 
 
-def im_create_payment_request(tg_id: int):
+def im_create_payment_request(tg_id=None):
+    # tg_id is optional: pool-created requests carry no metadata and are
+    # bound to a user via the pending table instead.
     payload = {
         "purpose": "Premium Membership",
-        "amount": str(PRICE_INR),
-        "redirect_url": f"{BASE_URL}/payment-return",
-        "webhook": f"{BASE_URL}/instamojo-webhook",
+        "amount": AMOUNT_STR,
+        "redirect_url": REDIRECT_URL,
+        "webhook": WEBHOOK_URL,
         "allow_repeated_payments": "false",
-        "metadata": json.dumps({"telegram_user_id": str(tg_id)}),
     }
-    body = "&".join([f"{k}={requests.utils.quote(v)}" for k, v in payload.items()])
-    r = requests.post(f"{IM_API_BASE}/payment-requests/", data=body, headers=im_headers(), timeout=20)
+    if tg_id is not None:
+        payload["metadata"] = METADATA_TMPL % tg_id
+    r = SESSION.post(f"{IM_API_BASE}/payment-requests/", data=payload, headers=IM_HEADERS, timeout=20)
     r.raise_for_status()
     pr = r.json()["payment_request"]
     return pr["longurl"], pr["id"]
 
 
+# Instamojo retries webhooks and can deliver duplicates; a short TTL cache on
+# settled payment requests makes the repeat verifications free. Runs on
+# to_thread workers, hence the lock. Non-terminal statuses are never cached.
+_PR_CACHE = TTLCache(maxsize=4096, ttl=60)
+_PR_CACHE_LOCK = threading.Lock()
+_PR_TERMINAL_STATUSES = ("Completed", "Credit", "Success", "Failed")
+
+
 def im_get_payment_request(req_id: str):
-    r = requests.get(f"{IM_API_BASE}/payment-requests/{req_id}/", headers=im_headers(), timeout=20)
+    with _PR_CACHE_LOCK:
+        cached = _PR_CACHE.get(req_id)
+    if cached is not None:
+        return cached
+    r = SESSION.get(f"{IM_API_BASE}/payment-requests/{req_id}/", headers=IM_HEADERS, timeout=20)
     r.raise_for_status()
-    return r.json().get("payment_request")
+    pr = r.json().get("payment_request")
+    if pr and pr.get("status") in _PR_TERMINAL_STATUSES:
+        with _PR_CACHE_LOCK:
+            _PR_CACHE[req_id] = pr
+    return pr
+
+# Pre-warmed pool of unattached payment requests: /pay hands one out and
+# redirects without waiting on an Instamojo round-trip.
+PR_POOL: asyncio.Queue = asyncio.Queue()
+_BG_TASKS = []
+
+
+async def _pr_pool_filler():
+    while True:
+        try:
+            if PR_POOL.qsize() < PR_POOL_SIZE:
+                PR_POOL.put_nowait(await asyncio.to_thread(im_create_payment_request))
+            else:
+                await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await asyncio.sleep(10)
+
+
+def _bind_pending(req_id: str, tg_id: int):
+    with DB_LOCK, conn:
+        conn.execute("INSERT OR REPLACE INTO pending VALUES(?,?)", (req_id, tg_id))
 
-# ----------------- Flask app (web server) -----------------
-flask_app = Flask(__name__)
 
-@flask_app.get("/")
-def health():
-    return {"ok": True, "time": datetime.now(IST).isoformat()}
+def _pop_pending(req_id: str):
+    with DB_LOCK, conn:
+        row = conn.execute("SELECT tg_id FROM pending WHERE req_id=?", (req_id,)).fetchone()
+        conn.execute("DELETE FROM pending WHERE req_id=?", (req_id,))
+    return row[0] if row else None
 
-@flask_app.get("/pay")
-def pay():
+# ----------------- Quart app (web server) -----------------
+web_app = Quart(__name__)
+
+# Monitoring hits these every few seconds; serve pre-built bytes instead of
+# allocating a datetime + dict + JSON encode per ping.
+_THANKS_BYTES = b"<h3>Thanks! Check your Telegram for the invite link.</h3>"
+
+@web_app.get("/")
+async def health():
+    return Response(b'{"ok": true, "ts": %d}' % int(time.time()), mimetype="application/json")
+
+@web_app.get("/pay")
+async def pay():
     tg = request.args.get("tg", "").strip()
     if not tg.isdigit():
         return "Invalid user", 400
     try:
-        url, req_id = im_create_payment_request(int(tg))
-        return redirect(url, code=302)
-    except Exception as e:
-        return f"Failed to create payment: {e}", 500
-
-@flask_app.post("/instamojo-webhook")
-def instamojo_webhook():
+        url, req_id = PR_POOL.get_nowait()
+    except asyncio.QueueEmpty:
+        # Pool drained (burst or filler down): fall back to a synchronous create.
+        try:
+            url, req_id = await asyncio.to_thread(im_create_payment_request, int(tg))
+        except Exception as e:
+            return f"Failed to create payment: {e}", 500
+    _bind_pending(req_id, int(tg))
+    return redirect(url, code=302)
+
+@web_app.post("/instamojo-webhook")
+async def instamojo_webhook():
     # Instamojo posts x-www-form-urlencoded
-    form = request.form.to_dict()
+    form = (await request.form).to_dict()
+
+    # Reject forged posts before spending a round-trip on verification.
+    # Instamojo's mac is HMAC-SHA1 over the '|'-joined values of the
+    # remaining fields, sorted by key, keyed with the account salt.
+    if IM_SALT:
+        mac = form.pop("mac", "")
+        msg = "|".join(form[k] for k in sorted(form)).encode()
+        calc = hmac.new(IM_SALT, msg, hashlib.sha1).hexdigest()
+        if not hmac.compare_digest(calc, mac):
+            return "bad sig", 403
+
     req_id = form.get("payment_request_id") or form.get("payment_request") or ""
     if not req_id:
         return "missing request id", 200
 
     try:
-        pr = im_get_payment_request(req_id)
+        pr = await asyncio.to_thread(im_get_payment_request, req_id)
     except Exception:
         return "verify failed", 200
 
@@ -140,111 +289,139 @@ def instamojo_webhook():
     if status not in ("Completed", "Credit", "Success"):
         return "ignored", 200
 
-    # Extract tg id from metadata
+    # Extract tg id from metadata, else from the pending binding made by /pay
     meta = pr.get("metadata") or {}
     if isinstance(meta, str):
-        try: meta = json.loads(meta)
+        try: meta = orjson.loads(meta)
         except Exception: meta = {}
     tg_id_str = str(meta.get("telegram_user_id", ""))
-    if not tg_id_str.isdigit():
-        return "no user", 200
-    tg_id = int(tg_id_str)
+    if tg_id_str.isdigit():
+        tg_id = int(tg_id_str)
+    else:
+        tg_id = _pop_pending(req_id)
+        if tg_id is None:
+            return "no user", 200
 
     try:
-        invite = create_single_use_invite(INVITE_LINK_TTL_SECONDS)
+        expire_unix = int(time.time()) + max(60, INVITE_LINK_TTL_SECONDS)
+        res = await tg_call(bot.create_chat_invite_link, CHANNEL_ID, expire_date=expire_unix, member_limit=1)
+        invite = res.invite_link
         expiry = datetime.now(IST) + timedelta(days=SUBSCRIPTION_DAYS)
-        DB[str(tg_id)] = {
-            "expiry_ts": int(expiry.timestamp()),
-            "last_payment": datetime.now(IST).isoformat(),
-            "status": "active",
-        }
-        save_db(DB)
-        text = (
-            "✅ *Payment Successful!*\n\n"
-            f"यह आपकी *private invite link* है (केवल 1 बार, {INVITE_LINK_TTL_SECONDS//60} मिनट में expire):\n"
-            f"{invite}\n\n"
-            f"_Access valid for {SUBSCRIPTION_DAYS} days._"
-        )
-        threading.Thread(target=send_dm_blocking, args=(tg_id, text), daemon=True).start()
+        upsert_sub(tg_id, int(expiry.timestamp()), "active", datetime.now(IST).isoformat())
+        await tg_call(bot.send_message, tg_id, text=PAYMENT_SUCCESS_TMPL % invite, parse_mode=ParseMode.MARKDOWN)
     except Exception:
         pass
 
     return "ok", 200
 
-@flask_app.get("/payment-return")
-def payment_return():
-    return "<h3>Thanks! Check your Telegram for the invite link.</h3>"
+@web_app.get("/payment-return")
+async def payment_return():
+    return Response(_THANKS_BYTES, mimetype="text/html")
 
-@flask_app.get("/run-expiry")
-def run_expiry_now():
+@web_app.post("/tg-webhook")
+async def tg_webhook():
+    # Telegram pushes updates here; no long-poll connection to keep open.
+    if TG_WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != TG_WEBHOOK_SECRET:
+        abort(401)
+    update = Update.de_json(await request.get_json(), bot)
+    app_telegram.update_queue.put_nowait(update)
+    return "", 200
+
+@web_app.get("/run-expiry")
+async def run_expiry_now():
     if CRON_SECRET and request.headers.get("X-CRON-SECRET") != CRON_SECRET:
         abort(401)
-    expiry_job()
+    await expiry_job()
     return jsonify({"ran": True, "ts": int(datetime.now(IST).timestamp())})
 
-# ----------------- Bot helpers -----------------
+# ----------------- Expiry automation -----------------
 
-def create_single_use_invite(ttl_seconds: int) -> str:
-    from telegram import Bot
-    bot = Bot(BOT_TOKEN)
-    expire_unix = int(time.time()) + max(60, ttl_seconds)
-    res = bot.create_chat_invite_link(chat_id=CHANNEL_ID, expire_date=expire_unix, member_limit=1)
-    return res.invite_link
+# Cap concurrent Telegram calls to stay under the ~30 msg/sec global limit.
+TG_CONCURRENCY = asyncio.Semaphore(10)
 
+# Guards against overlapping runs (cron tick firing while /run-expiry is busy).
+_EXPIRY_RUNNING = asyncio.Lock()
 
-def send_dm_blocking(user_id: int, text: str):
-    from telegram import Bot
-    bot = Bot(BOT_TOKEN)
-    try:
-        bot.send_message(chat_id=user_id, text=text, parse_mode=ParseMode.MARKDOWN)
-    except Exception:
-        pass
-
-# ----------------- Expiry automation -----------------
-
-def expiry_job():
-    now_ts = int(datetime.now(IST).timestamp())
-    if not DB:
-        return
-    from telegram import Bot
-    bot = Bot(BOT_TOKEN)
 
-    changed = False
-    for uid, rec in list(DB.items()):
+async def _expire_one(uid: int) -> int:
+    async with TG_CONCURRENCY:
+        # Remove (ban then unban to cleanly kick) — dependent, so sequential per user
+        await tg_call(bot.ban_chat_member, CHANNEL_ID, user_id=uid)
+        await tg_call(bot.unban_chat_member, CHANNEL_ID, user_id=uid, only_if_banned=True)
+        # DM rejoin
         try:
-            if rec.get("status") == "active" and int(rec.get("expiry_ts", 0)) <= now_ts:
-                # Remove (ban then unban to cleanly kick)
-                bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=int(uid))
-                bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=int(uid), only_if_banned=True)
-                DB[uid]["status"] = "expired"
-                DB[uid]["expired_at"] = datetime.now(IST).isoformat()
-                # DM rejoin
-                rejoin = (
-                    "🚫 आपकी subscription खत्म हो गई है.\n"
-                    f"दोबारा जुड़ने के लिए क्लिक करें और ₹{PRICE_INR} पे करें:\n"
-                    f"{BASE_URL}/pay?tg={uid}"
-                )
-                send_dm_blocking(int(uid), rejoin)
-                changed = True
+            await tg_call(bot.send_message, uid, text=REJOIN_TMPL % uid, parse_mode=ParseMode.MARKDOWN)
         except Exception:
-            continue
-    if changed:
-        save_db(DB)
+            pass
+        return uid
 
-# Optional in-process scheduler (best-effort; use Render Cron for reliability)
-scheduler = BackgroundScheduler(timezone=str(IST))
-scheduler.add_job(expiry_job, "cron", hour=2, minute=5)
-scheduler.start()
 
-# ----------------- Run both (Flask + polling) -----------------
-
-def run_flask():
-    flask_app.run(host="0.0.0.0", port=PORT)
-
-def run_bot():
-    app_telegram.run_polling(drop_pending_updates=True)
+async def expiry_job():
+    if _EXPIRY_RUNNING.locked():
+        return
+    async with _EXPIRY_RUNNING:
+        now_ts = int(datetime.now(IST).timestamp())
+        with DB_LOCK:
+            rows = conn.execute(
+                "SELECT tg_id FROM subs WHERE status='active' AND expiry_ts<=?", (now_ts,)
+            ).fetchall()
+        if not rows:
+            return
+        results = await asyncio.gather(*(_expire_one(uid) for (uid,) in rows), return_exceptions=True)
+        # One transaction for every user actually kicked, instead of a commit apiece.
+        kicked = [(uid,) for uid in results if isinstance(uid, int)]
+        if kicked:
+            with DB_LOCK, conn:
+                conn.executemany("UPDATE subs SET status='expired' WHERE tg_id=?", kicked)
+
+# In-process schedules (best-effort; use Render Cron for reliability)
+
+async def _daily_expiry_loop():
+    while True:
+        now = datetime.now(IST)
+        target = now.replace(hour=2, minute=5, second=0, microsecond=0)
+        if target <= now:
+            target += timedelta(days=1)
+        await asyncio.sleep((target - now).total_seconds())
+        await expiry_job()
+
+
+async def _wal_checkpoint_loop():
+    # Fold the append-only WAL back into the main DB so the -wal file
+    # doesn't grow without bound between restarts.
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            with DB_LOCK:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception:
+            pass
+
+# ----------------- Run both (web server + bot webhook, one loop) -----------------
+
+@web_app.before_serving
+async def _start_bot():
+    await app_telegram.initialize()
+    await app_telegram.start()
+    await bot.set_webhook(
+        f"{BASE_URL}/tg-webhook",
+        secret_token=TG_WEBHOOK_SECRET or None,
+        drop_pending_updates=True,
+    )
+    for coro in (_pr_pool_filler(), _daily_expiry_loop(), _wal_checkpoint_loop()):
+        _BG_TASKS.append(asyncio.create_task(coro))
+
+@web_app.after_serving
+async def _stop_bot():
+    for task in _BG_TASKS:
+        task.cancel()
+    await app_telegram.stop()
+    await app_telegram.shutdown()
+
+# ASGI entrypoint: uvicorn app:app --workers 1 (uvloop/httptools picked up
+# automatically from uvicorn[standard])
+app = web_app
 
 if __name__ == "__main__":
-    t = threading.Thread(target=run_flask, daemon=True)
-    t.start()
-    run_bot()
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=PORT)